@@ -5,13 +5,20 @@ import numpy as np
 # from sympy import N
 import h5py
 import os
+import tempfile
+import weakref
 from pathlib import Path
 
 from .detection_localisation.detect import detectData
 from .detection_lightning.detect import HSDetectionLightning as detectDataLightning
 from matplotlib import pyplot as plt
+from matplotlib.collections import LineCollection
+from matplotlib.colors import to_hex
+from scipy.spatial import cKDTree
 from .clustering.mean_shift_ import MeanShift
-from sklearn.decomposition import PCA
+from sklearn.decomposition import IncrementalPCA
+from sklearn.utils import gen_batches
+from joblib import Parallel, delayed
 from os.path import splitext
 import warnings
 from numpy.lib.stride_tricks import as_strided
@@ -25,6 +32,173 @@ def max_func(x):
     return x.max()
 
 
+def _sample_indices(n, k):
+    """
+    Draw k distinct indices out of n, without permuting all n of them. The
+    generator is seeded from the global numpy random state, so results can
+    still be reproduced with np.random.seed.
+    """
+    rng = np.random.default_rng(np.random.randint(2**32, dtype=np.uint64))
+    return rng.choice(n, k, replace=False, shuffle=False)
+
+
+def _read_direct(dset, dtype=None):
+    """
+    Read a whole hdf5 dataset into a new array with a single read_direct call,
+    converting to dtype if given.
+    """
+    out = np.empty(dset.shape, dtype=dset.dtype if dtype is None else dtype)
+    if out.size > 0:
+        dset.read_direct(out)
+    return out
+
+
+def _empty_shapes(shape, dtype=np.int32):
+    """
+    Allocate an uninitialised array for spike shapes. If it does not fit in
+    memory, fall back to a memmap on a unique temporary file, which is removed
+    once the array is released.
+    """
+    try:
+        return np.empty(shape, dtype=dtype)
+    except MemoryError:
+        f = tempfile.NamedTemporaryFile(suffix=".bin")
+        shapes = np.memmap(f, dtype=dtype, mode="w+", shape=shape)
+        weakref.finalize(shapes, f.close)
+        return shapes
+
+
+def _shape_segments(shapes):
+    # (n, L) cutouts as (n, L, 2) line segments for a LineCollection
+    n, length = shapes.shape
+    segs = np.empty((n, length, 2), dtype=np.float32)
+    segs[:, :, 0] = np.arange(length)
+    segs[:, :, 1] = shapes
+    return segs
+
+
+def _group_means(shapes, groups):
+    """
+    Mean shape of each group of spike indices, computed for all groups in a
+    single reduction. Empty groups give NaN.
+    """
+    sizes = np.array([len(g) for g in groups], dtype=np.intp)
+    means = np.full((len(groups), shapes.shape[1]), np.nan, dtype=np.float32)
+    nonempty = sizes > 0
+    if np.any(nonempty):
+        starts = (np.cumsum(sizes) - sizes)[nonempty]
+        sums = np.add.reduceat(
+            shapes[np.concatenate(groups)], starts, axis=0, dtype=np.float32
+        )
+        means[nonempty] = sums / sizes[nonempty, None]
+    return means
+
+
+def _select_first(inds, n, score=None):
+    """
+    The n entries of inds with the lowest score (indexed by spike), in no
+    particular order, found by partial sorting. Without a score the first n
+    are taken.
+    """
+    if score is None or len(inds) <= n:
+        return inds[:n]
+    return inds[np.argpartition(score[inds], n - 1)[:n]]
+
+
+def _render_scatter(ax, x, y, labels, rgba, alpha, backend="matplotlib"):
+    """
+    Scatter plot of spike positions on ax, where point i has colour
+    rgba[labels[i]]. The "datashader" backend rasterises the points and shows
+    the image on ax. The "jscatter" backend displays an interactive WebGL
+    scatter plot next to the figure and leaves ax empty. Both packages are
+    optional and only imported when requested.
+    """
+    if backend == "matplotlib":
+        ax.scatter(x, y, c=rgba[labels], s=3, alpha=alpha)
+    elif backend == "datashader":
+        import datashader as ds
+        import datashader.transfer_functions as tf
+
+        df = pd.DataFrame({"x": x, "y": y, "cl": pd.Categorical(labels)})
+        x_range = (float(x.min()), float(x.max()))
+        y_range = (float(y.min()), float(y.max()))
+        canvas = ds.Canvas(
+            plot_width=800, plot_height=800, x_range=x_range, y_range=y_range
+        )
+        agg = canvas.points(df, "x", "y", ds.count_cat("cl"))
+        color_key = {
+            c: to_hex(rgba[c]) for c in df.cl.cat.categories
+        }
+        img = tf.shade(agg, color_key=color_key, how="eq_hist")
+        # rows of the aggregate run along increasing y
+        pixels = img.data.view(np.uint8).reshape(img.shape + (4,))
+        ax.imshow(
+            pixels,
+            extent=x_range + y_range,
+            origin="lower",
+            alpha=alpha,
+            interpolation="nearest",
+        )
+    elif backend == "jscatter":
+        import jscatter
+        from IPython.display import display
+
+        df = pd.DataFrame({"x": x, "y": y, "cl": pd.Categorical(labels)})
+        color_map = {
+            c: to_hex(rgba[c]) for c in df.cl.cat.categories
+        }
+        display(
+            jscatter.Scatter(
+                data=df,
+                x="x",
+                y="y",
+                color_by="cl",
+                color_map=color_map,
+                opacity=alpha,
+                size=3,
+            ).show()
+        )
+    else:
+        raise ValueError(
+            "Unknown backend {}, expected matplotlib, datashader or "
+            "jscatter".format(backend)
+        )
+
+
+def _read_shapes(dset, chunk_size, scale=1.0):
+    """
+    Read spike shapes stored as (cutout_length, n_spikes) in a hdf5 dataset into
+    a (n_spikes, cutout_length) integer array, chunk_size spikes at a time. For
+    chunked datasets the blocks are aligned to the chunk layout. Shapes are
+    stored as int16, unless the (scaled) data does not fit, then as int32.
+    """
+    cutout_length, n_spikes = dset.shape
+    shapes = _empty_shapes((n_spikes, cutout_length), np.int16)
+    limits = np.iinfo(np.int16)
+    if dset.chunks is None:
+        # contiguous: every block is cutout_length contiguous runs, and the
+        # buffer stays bounded by chunk_size
+        step = max(chunk_size, 1)
+    else:
+        step = max(chunk_size // dset.chunks[1], 1) * dset.chunks[1]
+    # each block is read into a reusable buffer, then scaled and cast straight
+    # into the preallocated output
+    buf = np.empty((cutout_length, min(step, n_spikes)), dtype=dset.dtype)
+    for i, start in enumerate(range(0, n_spikes, step)):
+        stop = min(start + step, n_spikes)
+        dset.read_direct(buf, np.s_[:, start:stop], np.s_[:, : stop - start])
+        block = buf[:, : stop - start]
+        if shapes.dtype == np.int16:
+            lo, hi = sorted((block.min() * scale, block.max() * scale))
+            if lo < limits.min or hi > limits.max:
+                wide = _empty_shapes(shapes.shape, np.int32)
+                wide[:start] = shapes[:start]
+                shapes = wide
+        np.multiply(block.T, scale, out=shapes[start:stop], casting="unsafe")
+        print("Read chunk " + str(i + 1))
+    return shapes
+
+
 class HSDetection(object):
     """
     This class provides a simple interface to the detection, localisation of
@@ -131,6 +305,9 @@ class HSDetection(object):
         self.num_com_centers = num_com_centers
         self.sp_flat = None
         self.spikes = None
+        self.shapes = None
+        self._read_cache = (None, None, None)
+        self._interdistance_cache = {}
 
         self.sampling = probe.fps
 
@@ -192,22 +369,23 @@ class HSDetection(object):
             #             self.sp_flat = np.memmap(file_name, dtype=np.int16, mode="r")
             self.sp_flat = np.memmap(file_name, dtype=np.int32, mode="r")
             assert (
-                self.sp_flat.shape[0] // self.cutout_length + 5
-                is not self.sp_flat.shape[0] / self.cutout_length + 5
-            ), "spike data has wrong dimensions"  # ???
+                self.sp_flat.shape[0] % (self.cutout_length + 5) == 0
+            ), "spike data has wrong dimensions"
             shapecache = self.sp_flat.reshape((-1, self.cutout_length + 5))
 
+        # integer columns and shapes are views into the memmap, only the
+        # locations are converted (to single precision)
         self.spikes = pd.DataFrame(
             {
                 "ch": shapecache[:, 0],
                 "t": shapecache[:, 1],
                 "Amplitude": shapecache[:, 2],
-                "x": shapecache[:, 3] / 1000,
-                "y": shapecache[:, 4] / 1000,
-                "Shape": list(shapecache[:, 5:]),
+                "x": np.divide(shapecache[:, 3], 1000, dtype=np.float32),
+                "y": np.divide(shapecache[:, 4], 1000, dtype=np.float32),
             },
             copy=False,
         )
+        self.shapes = shapecache[:, 5:]
         self.IsClustered = False
         print("Loaded " + str(self.spikes.shape[0]) + " spikes.")
 
@@ -300,63 +478,69 @@ class HSDetection(object):
 
         pos, neighs = self.probe.positions, self.probe.neighbors
 
-        event = self.spikes.loc[eventid]
-        print("Spike detected at channel: ", event.ch)
-        print("Spike detected at frame: ", event.t)
-        print("Spike localised in position", event.x, event.y)
-        cutlen = len(event.Shape)
+        # read the scalars positionally with their own dtypes, a row of the
+        # all-numeric spikes frame would upcast them to float
+        ch = int(self.spikes.ch.iat[eventid])
+        t = int(self.spikes.t.iat[eventid])
+        sx, sy = self.spikes.x.iat[eventid], self.spikes.y.iat[eventid]
+        print("Spike detected at channel: ", ch)
+        print("Spike detected at frame: ", t)
+        print("Spike localised in position", sx, sy)
+        shape = self.shapes[eventid]
+        cutlen = len(shape)
 
-        # compute distance between electrodes, for scaling
-        distances = np.abs(pos[event.ch][0] - pos[neighs[event.ch]][:, 0])
-        interdistance = np.min(distances[distances > 0])
-        scale = interdistance / 110.0 * ascale
+        scale = self._interdistance(ch) / 110.0 * ascale
 
         # scatter of the large grey balls for electrode location
-        x = pos[(neighs[event.ch], 0)]
-        y = pos[(neighs[event.ch], 1)]
+        x = pos[(neighs[ch], 0)]
+        y = pos[(neighs[ch], 1)]
         if show_channels:
-            plt.scatter(x, y, s=1600, alpha=0.2)
+            ax.scatter(x, y, s=1600, alpha=0.2)
 
         ws = window_size // 2
         ws = max(ws, 1 + self.cutout_start, 1 + self.cutout_end)
-        t1 = np.max((0, event.t - ws))
-        t2 = event.t + ws
+        t1 = np.max((0, t - ws))
+        t2 = t + ws
 
-        trange = (np.arange(t1, t2) - event.t) * scale
-        start_bluered = event.t - t1 - self.cutout_start
+        trange = (np.arange(t1, t2) - t) * scale
+        start_bluered = t - t1 - self.cutout_start
         trange_bluered = trange[start_bluered : start_bluered + cutlen]
 
-        data = self.probe.Read(t1, t2).reshape((t2 - t1, self.probe.num_channels))
+        data = self._read_window(t1, t2)
         # remove offsets
         data = data - data[0]
 
-        # grey and blue traces
-        for i, n in enumerate(neighs[event.ch]):
-            dist_from_max = np.sqrt(
-                (pos[n][0] - pos[event.ch][0]) ** 2
-                + (pos[n][1] - pos[event.ch][1]) ** 2
-            )
-            if n in self.probe.masked_channels:
-                col = "g"
-            elif dist_from_max <= self.probe.inner_radius:
-                col = "orange"
-            else:
-                col = "b"
-            plt.plot(pos[n][0] + trange, pos[n][1] + data[:, n] * scale, "gray")
-            plt.plot(
-                pos[n][0] + trange_bluered,
-                pos[n][1] + data[start_bluered : start_bluered + cutlen, n] * scale,
-                col,
+        # grey and blue traces, one collection each for all neighbours
+        n = neighs[ch]
+        dist_from_max = np.sqrt(np.sum((pos[n] - pos[ch]) ** 2, axis=1))
+        cols = np.where(
+            np.isin(n, self.probe.masked_channels),
+            "g",
+            np.where(dist_from_max <= self.probe.inner_radius, "orange", "b"),
+        )
+        traces = np.stack(
+            (
+                pos[n, 0, None] + trange[None, :],
+                pos[n, 1, None] + data[:, n].T * scale,
+            ),
+            axis=-1,
+        )
+        ax.add_collection(LineCollection(traces, colors="gray"))
+        ax.add_collection(
+            LineCollection(
+                traces[:, start_bluered : start_bluered + cutlen], colors=list(cols)
             )
+        )
+        ax.autoscale_view()
 
         # red overlay for central channel
-        plt.plot(
-            pos[event.ch][0] + trange_bluered,
-            pos[event.ch][1] + event.Shape * scale,
+        ax.plot(
+            pos[ch][0] + trange_bluered,
+            pos[ch][1] + shape * scale,
             "r",
         )
         inner_radius_circle = plt.Circle(
-            (pos[event.ch][0], pos[event.ch][1]),
+            (pos[ch][0], pos[ch][1]),
             self.probe.inner_radius,
             color="red",
             fill=False,
@@ -365,15 +549,32 @@ class HSDetection(object):
 
         # red dot of event location
         if show_loc:
-            plt.scatter(event.x, event.y, s=80, c="r")
+            ax.scatter(sx, sy, s=80, c="r")
 
         # electrode numbers
         if show_channel_numbers:
-            for i, txt in enumerate(neighs[event.ch]):
+            for i, txt in enumerate(neighs[ch]):
                 ax.annotate(txt, (x[i], y[i]))
         ax.set_aspect("equal")
         return ax
 
+    def _interdistance(self, channel):
+        # distance between electrodes, for scaling; this only depends on the
+        # probe, so it is computed once per channel
+        if channel not in self._interdistance_cache:
+            pos, neighs = self.probe.positions, self.probe.neighbors
+            distances = np.abs(pos[channel][0] - pos[neighs[channel]][:, 0])
+            self._interdistance_cache[channel] = np.min(distances[distances > 0])
+        return self._interdistance_cache[channel]
+
+    def _read_window(self, t1, t2):
+        # interactive plotting tends to revisit the same window, so the raw
+        # data of the last one is kept
+        if self._read_cache[:2] != (t1, t2):
+            data = self.probe.Read(t1, t2).reshape((t2 - t1, self.probe.num_channels))
+            self._read_cache = (t1, t2, data)
+        return self._read_cache[2]
+
     def PlotDensity(self, binsize=1.0, invert=False, ax=None):
         """
         Plot the density of the spikes on the probe.
@@ -439,7 +640,7 @@ class HSDetection(object):
         if invert:
             x, y = y, x
         if self.spikes.shape[0] > max_show:
-            inds = np.random.choice(self.spikes.shape[0], max_show, replace=False)
+            inds = _sample_indices(self.spikes.shape[0], max_show)
             print("We have", self.spikes.shape[0], "spikes, only showing", max_show)
         else:
             inds = np.arange(self.spikes.shape[0])
@@ -491,6 +692,7 @@ class HSDetectionLightning(object):
     def __init__(self, rec, params=None):
         self.sp_flat = None
         self.spikes = None
+        self.shapes = None
         self.recording = rec
         self.num_segments = rec.get_num_segments()
         self.sampling = rec.get_sampling_frequency()
@@ -517,7 +719,7 @@ class HSDetectionLightning(object):
         det = detectDataLightning(self.recording, self.params)
         sp = det.detect()
         if self.params["save_shape"] == False:  # create dummy if no shapes saved
-            sp[0]["spike_shape"] = np.zeros(len(sp[0]["sample_index"]))
+            sp[0]["spike_shape"] = np.zeros((len(sp[0]["sample_index"]), 1))
         if self.params["localize"] == False:  # create dummy if no shapes saved
             sp[0]["location"] = np.zeros((len(sp[0]["sample_index"]), 2))
         self.spikes = pd.DataFrame(
@@ -527,12 +729,13 @@ class HSDetectionLightning(object):
                 "Amplitude": sp[0]["amplitude"],
                 "x": sp[0]["location"][:, 0],
                 "y": sp[0]["location"][:, 1],
-                "Shape": list(-sp[0]["spike_shape"]),
             },
             copy=False,
         )
         # check if any spikes
         assert self.spikes.shape[0] > 0, "No spikes detected"
+        # spike_shape is already (n_spikes, cutout_length)
+        self.shapes = -sp[0]["spike_shape"]
         # write spikes dict to hdf5 (without shapes)
         if self.out_file_name is not None:
             if self.params["verbose"]:
@@ -541,11 +744,8 @@ class HSDetectionLightning(object):
             for key in ["ch", "t", "Amplitude", "x", "y"]:
                 h.create_dataset(key, data=self.spikes[key])
             if self.params["save_shape"]:
-                h["cutout_length"] = self.spikes["Shape"][0].shape[0]
-                sh_tmp = np.empty((h["cutout_length"][()], self.spikes.Shape.size))
-                for i, s in enumerate(self.spikes.Shape):
-                    sh_tmp[:, i] = s
-                h.create_dataset("Shape", data=sh_tmp)#, compression=compression)
+                h["cutout_length"] = self.shapes.shape[1]
+                h.create_dataset("Shape", data=self.shapes.T)#, compression=compression)
             else:
                 h["cutout_length"] = 0
             h.close()
@@ -573,9 +773,10 @@ class HSDetectionLightning(object):
                 "Amplitude": [],
                 "x": [],
                 "y": [],
-                "Shape": [],
             },
+            copy=False,
         )
+            self.shapes = np.empty((0, 0))
             warnings.warn(
                 "Loading an empty file {} . This usually happens when no spikes were"
                 "detected due to the detection parameters being set too "
@@ -586,15 +787,18 @@ class HSDetectionLightning(object):
         
         self.spikes = pd.DataFrame(
             {
-                "ch": h['ch'],
-                "t": h['t'],
-                "Amplitude": h['Amplitude'],
-                "x": h['x'],
-                "y": h['y'],
-                "Shape": list(np.transpose(h['Shape'])),
+                "ch": _read_direct(h['ch']),
+                "t": _read_direct(h['t']),
+                "Amplitude": _read_direct(h['Amplitude']),
+                "x": _read_direct(h['x']),
+                "y": _read_direct(h['y']),
             },
             copy=False,
         )
+        # shapes are kept apart from the spikes frame, as one contiguous
+        # (n_spikes, cutout_length) array
+        self.shapes = np.ascontiguousarray(_read_direct(h['Shape']).T)
+        h.close()
         self.IsClustered = False
         print("Loaded " + str(self.spikes.shape[0]) + " spikes.")
 
@@ -674,7 +878,7 @@ class HSDetectionLightning(object):
         if invert:
             x, y = y, x
         if self.spikes.shape[0] > max_show:
-            inds = np.random.choice(self.spikes.shape[0], max_show, replace=False)
+            inds = _sample_indices(self.spikes.shape[0], max_show)
             print("We have", self.spikes.shape[0], "spikes, only showing", max_show)
         else:
             inds = np.arange(self.spikes.shape[0])
@@ -731,46 +935,59 @@ class HSClustering(object):
         **kwargs,
     ):
         self.verbose = verbose
-        self.shapecache = []
+        self._cl_index = None
+        self._cl_trees = {}
+        self._cluster_rgba = None
+        self._neighbourhood_cache = (None, None)
+        self._cache_source = None
         self.sampling = None
         if type(arg1) == pd.core.frame.DataFrame:
             if self.verbose:
                 print("Reading spikes from Dataframe")
-            self.spikes = arg1
+            if "Shape" in arg1.columns:
+                self.shapes = np.vstack(arg1.Shape.values)
+                self.spikes = arg1.drop(columns="Shape")
+            else:
+                self.shapes = None
+                self.spikes = arg1
             self.expinds = [0]
         elif (type(arg1) == HSDetectionLightning) or (type(arg1) == HSDetection):
             if self.verbose:
                 print("Reading spikes from detection")
             self.spikes = arg1.spikes
+            self.shapes = arg1.shapes
             self.expinds = [0]
             self.sampling = arg1.sampling
         else:
             if type(arg1) == str:
                 arg1 = [arg1]
+            # data from all files is collected first and concatenated once
+            spikes_list, shapes_list = [], []
             if legacy:
-                for i, f in enumerate(arg1):
+                for f in arg1:
                     filetype = splitext(f)[-1]
-                    not_first_file = i > 0
                     if filetype == ".hdf5":
                         _f = h5py.File(f, "r")
-                        if "shapes" in list(_f.keys()):
-                            _f.close()
-                            self.LoadHDF5(f, append=not_first_file, **kwargs)
-                        elif "Shapes" in list(_f.keys()):
-                            _f.close()
-                            self.LoadHDF5_legacy_detected(
-                                f, append=not_first_file, **kwargs
-                            )
+                        keys = list(_f.keys())
+                        _f.close()
+                        if "shapes" in keys:
+                            self.LoadHDF5(f, **kwargs)
+                        elif "Shapes" in keys:
+                            self.LoadHDF5_legacy_detected(f, **kwargs)
+                        else:
+                            raise IOError(f"No spike shapes found in {f}")
                     elif filetype == ".bin":
                         if cutout_length is None:
                             raise ValueError(
                                 "You must pass cutout_length for .bin files."
                             )
-                        self.LoadBin(f, cutout_length, append=not_first_file)
+                        self.LoadBin(f, cutout_length)
                     else:
                         raise IOError("File format unknown. Expected .hdf5 or .bin")
+                    spikes_list.append(self.spikes)
+                    shapes_list.append(self.shapes)
             else:
-                for i, f in enumerate(arg1):
+                for f in arg1:
                     # There's some legacy stuff to deal with here, trying to make it consistent for now.
                     # If a .hdf5 file is provided, it'll look for shapes in theer first.
                     # If shapes are not there, it'll look doe a .bin file with the same name and try to load that.
@@ -780,33 +997,11 @@ class HSClustering(object):
                     cutout_length = spikes_data["cutout_length"][()]
                     if "shapes" in spikes_data.keys():
                         print(f"loading spike shapes from {spikes_file}")
-                        i = len(self.shapecache)
-                        self.shapecache.append(
-                            np.memmap(
-                                "tmp" + str(i) + ".bin",
-                                dtype=np.int32,
-                                mode="w+",
-                                shape=spikes_data["shapes"].shape[::-1],
-                            )
-                        )
-                        for ii in range(
-                            spikes_data["shapes"].shape[1] // chunk_size + 1
-                        ):
-                            tmp = (
-                                np.transpose(
-                                    spikes_data["shapes"][
-                                        :, ii * chunk_size : (ii + 1) * chunk_size
-                                    ]
-                                )
-                            ).astype(np.int32)
-                            print("Read chunk " + str(ii + 1))
-                            self.shapecache[-1][
-                                ii * chunk_size : (ii + 1) * chunk_size
-                            ] = tmp[:]
-
-                        self.cutout_length = self.shapecache[-1].shape[1]
+                        shapes = _read_shapes(spikes_data["shapes"], chunk_size)
+
+                        self.cutout_length = shapes.shape[1]
                         if self.verbose:
-                            print(f'Spikes loaded: {self.shapecache[-1].shape[0]}')
+                            print(f'Spikes loaded: {shapes.shape[0]}')
                             print(f'Cut-out size: {self.cutout_length} frames')
 
                     else:
@@ -823,10 +1018,8 @@ class HSClustering(object):
                         shapes = np.memmap(
                             str(shape_file), dtype=np.int16, mode="r"
                         ).reshape(-1, cutout_length)
-                        self.shapecache.append(shapes)
                     spikes = pd.DataFrame(
                         {
-                            "Shape": list(self.shapecache[-1]),
                             "ch": spikes_data["ch"],
                             "t": spikes_data["times"],
                             "Amplitude": spikes_data["Amplitude"],
@@ -835,16 +1028,137 @@ class HSClustering(object):
                         },
                         copy=False,
                     )
-                    if i > 0:
-                        self.expinds.append(len(self.spikes))
-                        self.spikes = pd.concat(
-                            [self.spikes, spikes], ignore_index=True
-                        )
-                        self.filelist.append(arg1)
-                    else:
-                        self.spikes = spikes
-                        self.expinds = [0]
-                        self.filelist = [arg1]
+                    spikes_list.append(spikes)
+                    shapes_list.append(shapes)
+            self._concatenate(spikes_list, shapes_list, arg1)
+
+    def _concatenate(self, spikes_list, shapes_list, filelist):
+        # a single experiment is used as is, so memmapped shapes stay on disk
+        if len(spikes_list) > 1:
+            self.spikes = pd.concat(spikes_list, ignore_index=True)
+            self.shapes = np.concatenate(shapes_list)
+        else:
+            self.spikes = spikes_list[0]
+            self.shapes = shapes_list[0]
+        self.expinds = np.cumsum([0] + [len(s) for s in spikes_list[:-1]]).tolist()
+        self.filelist = list(filelist)
+        self._reset_cluster_caches()
+
+    def _reset_cluster_caches(self):
+        # called whenever spikes or clusters are rebuilt
+        self._cl_index = None
+        self._cl_trees = {}
+        self._cluster_rgba = None
+        self._neighbourhood_cache = (None, None)
+        self._cache_source = None
+
+    def _check_cluster_caches(self):
+        # the cluster index, kd-trees and neighbourhood memo are derived from
+        # the labels, the cluster centres and the spike positions. They are
+        # kept with a copy of the labels and centres they were built from, and
+        # a view of the positions, so that direct edits to spikes or clusters
+        # (e.g. merging units) are picked up. Called once per plot rather than
+        # per lookup.
+        labels = self.spikes.cl.to_numpy()
+        ctrs = self.clusters[["ctr_x", "ctr_y"]].to_numpy()
+        x = self.spikes.x.to_numpy()
+        source = self._cache_source
+        if (
+            source is None
+            or not np.may_share_memory(source[2], x)
+            or not np.array_equal(source[0], labels)
+            or not np.array_equal(source[1], ctrs, equal_nan=True)
+        ):
+            self._cl_index = None
+            self._cl_trees = {}
+            self._neighbourhood_cache = (None, None)
+            self._cache_source = (labels.copy(), ctrs.copy(), x)
+
+    def _cluster_colors(self):
+        # RGBA colour of every cluster from a single colormap call, kept with
+        # a copy of the Color values it was made from, so that recolouring
+        # clusters directly is picked up
+        color = self.clusters["Color"].to_numpy()
+        if self._cluster_rgba is None or not np.array_equal(
+            self._cluster_rgba[0], color
+        ):
+            self._cluster_rgba = (color.copy(), plt.cm.hsv(color))
+        return self._cluster_rgba[1]
+
+    def _neighbourhood(self, cl, radius, max_shapes, max_clusters, unclustered):
+        # units and spikes shown by PlotNeighbourhood, with the mean shapes.
+        # The last result is kept, so redrawing the same neighbourhood skips
+        # the computation; it is reset with the cluster caches, see
+        # _check_cluster_caches.
+        key = (cl, radius, max_shapes, max_clusters, unclustered)
+        if self._neighbourhood_cache[0] == key:
+            return self._neighbourhood_cache[1]
+        ctr_x = self.clusters["ctr_x"].to_numpy()
+        ctr_y = self.clusters["ctr_y"].to_numpy()
+        cx, cy = ctr_x[cl], ctr_y[cl]
+        clInds = self._points_within("clusters", cx, cy, radius)
+        if len(clInds) > max_clusters:
+            warnings.warn(
+                "{} units within radius {}, only showing the {} closest".format(
+                    len(clInds), radius, max_clusters
+                )
+            )
+            d2 = (ctr_x[clInds] - cx) ** 2 + (ctr_y[clInds] - cy) ** 2
+            nearest = np.argpartition(d2, max_clusters - 1)[:max_clusters]
+            clInds = np.sort(clInds[nearest])
+        groups = [self._cluster_spikes(cl_t)[:max_shapes] for cl_t in clInds]
+        means = _group_means(self.shapes, groups)
+        if unclustered:
+            spInds = self._points_within("unclustered", cx, cy, radius)[:max_shapes]
+        else:
+            spInds = None
+        self._neighbourhood_cache = (key, (clInds, groups, means, spInds))
+        return self._neighbourhood_cache[1]
+
+    def _cluster_spikes(self, cl):
+        # spike indices of cluster cl, in spike order. The labels are sorted
+        # once into CSR form (order, boundaries); labels run from 0 to
+        # NClusters-1, so a label is its own slot. Reset whenever spikes or
+        # clusters change, see _check_cluster_caches.
+        if self._cl_index is None:
+            labels = self.spikes.cl.to_numpy()
+            order = np.argsort(labels, kind="stable")
+            sizes = np.bincount(labels, minlength=self.NClusters)
+            boundaries = np.concatenate(([0], np.cumsum(sizes)))
+            self._cl_index = (order, boundaries)
+        order, boundaries = self._cl_index
+        return order[boundaries[cl] : boundaries[cl + 1]]
+
+    def _points_within(self, kind, cx, cy, radius):
+        # indices of the cluster centres (kind="clusters") or of the
+        # unclustered spikes (kind="unclustered", the last cluster) within
+        # radius of (cx, cy). Each kd-tree is only built when first needed and
+        # is reset with the cluster index. Empty clusters have NaN centres and
+        # are left out.
+        if kind not in self._cl_trees:
+            if kind == "clusters":
+                ctrs = self.clusters[["ctr_x", "ctr_y"]].to_numpy()
+                inds = np.flatnonzero(np.isfinite(ctrs).all(axis=1))
+                pos = ctrs[inds]
+            else:
+                inds = self._cluster_spikes(self.NClusters - 1)
+                pos = np.column_stack(
+                    (self.spikes.x.to_numpy()[inds], self.spikes.y.to_numpy()[inds])
+                )
+            self._cl_trees[kind] = (inds, cKDTree(pos))
+        inds, tree = self._cl_trees[kind]
+        found = tree.query_ball_point((cx, cy), r=radius, return_sorted=True)
+        return inds[np.asarray(found, dtype=np.intp)]
+
+    def _add_experiment(self, spikes, shapes, filename, append):
+        if append:
+            expinds = self.expinds + [len(self.spikes)]
+            self._concatenate(
+                [self.spikes, spikes], [self.shapes, shapes], self.filelist + [filename]
+            )
+            self.expinds = expinds
+        else:
+            self._concatenate([spikes], [shapes], [filename])
 
     def CombinedClustering(
         self, alpha, clustering_algorithm=None, cluster_subset=None, **kwargs
@@ -868,29 +1182,32 @@ class HSClustering(object):
             nearest by Euclidean distance
         **kwargs : dict
             Additional arguments are passed to the clustering class. This may include
-            n_jobs > 1 for parallelisation.
+            n_jobs > 1 for parallelisation. The default MeanShift uses bin_seeding=True,
+            min_bin_freq=4 and n_jobs=-1 unless set here.
         """
+        n_spikes = self.spikes.shape[0]
         try:
-            fourvec = np.vstack(
-                (self.spikes.x, self.spikes.y, alpha * self.features.T)
-            ).T
+            features = self.features
         except AttributeError:
-            fourvec = np.vstack((self.spikes.x, self.spikes.y)).T
+            features = np.empty((n_spikes, 0))
             print("Warning: no PCA or other features available, location only!")
+        fourvec = np.empty((n_spikes, 2 + features.shape[1]), dtype=np.float32)
+        fourvec[:, 0] = self.spikes.x
+        fourvec[:, 1] = self.spikes.y
+        np.multiply(features, alpha, out=fourvec[:, 2:])
 
         print("Clustering...")
         if clustering_algorithm is None:
+            kwargs.setdefault("bin_seeding", True)
+            kwargs.setdefault("min_bin_freq", 4)
+            kwargs.setdefault("n_jobs", -1)
             clusterer = MeanShift(**kwargs)
         else:
             clusterer = clustering_algorithm(**kwargs)
 
         if cluster_subset is not None:
             print("Using", cluster_subset, "out of", self.spikes.shape[0], "spikes...")
-            inds = np.sort(
-                np.random.choice(
-                    self.spikes.shape[0], int(cluster_subset), replace=False
-                )
-            )
+            inds = np.sort(_sample_indices(self.spikes.shape[0], int(cluster_subset)))
             clusterer.fit(fourvec[inds])
             self.NClusters = len(np.unique(clusterer.labels_))
             if self.verbose:
@@ -898,7 +1215,13 @@ class HSClustering(object):
                 print(
                     "Predicting cluster labels for", self.spikes.shape[0], "spikes..."
                 )
-            self.spikes["cl"] = clusterer.predict(fourvec)
+            # labels are predicted in parallel over batches of spikes
+            self.spikes["cl"] = np.concatenate(
+                Parallel(n_jobs=kwargs.get("n_jobs"), prefer="threads")(
+                    delayed(clusterer.predict)(fourvec[batch])
+                    for batch in gen_batches(n_spikes, 1000000)
+                )
+            )
         else:
             if self.verbose:
                 print("Clustering " + str(self.spikes.shape[0]) + " spikes...")
@@ -909,24 +1232,46 @@ class HSClustering(object):
 
         # methods like DBSCAN assign '-1' to unclustered data
         # here we replace these by a new cluster at the end of the list
-        if self.spikes.cl.min() == -1:
+        labels = self.spikes.cl.to_numpy()
+        unclustered = labels == -1
+        if unclustered.any():
             if self.verbose:
                 print(
                     "There are",
-                    (self.spikes.cl == -1).sum(),
+                    np.count_nonzero(unclustered),
                     "unclustered events, these are now in cluster number ",
                     self.NClusters - 1,
                 )
-            self.spikes.loc[self.spikes.cl == -1, "cl"] = self.NClusters - 1
-
-        _cl = self.spikes.groupby(["cl"])
-        _x_mean = _cl.x.mean()
-        _y_mean = _cl.y.mean()
-        _cls = _cl.cl.count()
+            labels = np.where(unclustered, self.NClusters - 1, labels)
+            self.spikes["cl"] = labels
+
+        # cluster sizes and centres in one pass each over the labels
+        _cls = np.bincount(labels, minlength=self.NClusters)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            _x_mean = (
+                np.bincount(labels, weights=self.spikes.x, minlength=self.NClusters)
+                / _cls
+            )
+            _y_mean = (
+                np.bincount(labels, weights=self.spikes.y, minlength=self.NClusters)
+                / _cls
+            )
+        if np.any(_cls == 0):
+            warnings.warn(
+                "{} clusters have no spikes assigned, their centres are set to "
+                "NaN".format(np.sum(_cls == 0))
+            )
         _color = 1.0 * np.random.permutation(self.NClusters) / self.NClusters
-        dic_cls = {"ctr_x": _x_mean, "ctr_y": _y_mean, "Color": _color, "Size": _cls}
+        # centres are kept in float32, like the spike positions
+        dic_cls = {
+            "ctr_x": _x_mean.astype(np.float32),
+            "ctr_y": _y_mean.astype(np.float32),
+            "Color": _color,
+            "Size": _cls,
+        }
         self.clusters = pd.DataFrame(dic_cls)
         self.IsClustered = True
+        self._reset_cluster_caches()
 
     def ShapePCA(
         self,
@@ -938,7 +1283,8 @@ class HSClustering(object):
         """
         Computes the principal components of the spike shapes contained in the class,
         and computes projections of the spikes on these components. The features are
-        saved to HSClustering.features, to be used for clustering.
+        saved to HSClustering.features, to be used for clustering. By default, PCA is
+        fitted incrementally on all spikes, in batches of chunk_size.
 
         Parameters
         ----------
@@ -947,7 +1293,8 @@ class HSClustering(object):
         pca_whiten : bool
             Whiten data before PCA
         chunk_size : int
-            Maximum number of shapes to be used to find PCs
+            Number of shapes processed per batch. With a custom decomposition, this
+            is the maximum number of shapes used to fit it.
         custom_decomposition : sklearn.decomposition object
             A custom instance of a sklearn decomposition object (such as instances PCA
             or FastICA), to be used for custom dimensionality reduction. pca_ncomponents
@@ -964,43 +1311,62 @@ class HSClustering(object):
             result = as_strided(arr_roll, (*arr.shape, n), (strd_0, strd_1, strd_1))
             return result[np.arange(arr.shape[0]), (n - m) % n]
 
-        n_spikes = self.spikes.shape[0]
+        def peaks(s):
+            return np.argmin(np.diff(s, axis=1), axis=1)
+
+        def align_peaks(s, ref=None):
+            # roll all shapes so that their peaks are at sample ref, by
+            # default the earliest peak in s
+            peak = peaks(s)
+            if ref is None:
+                ref = np.min(peak)
+            return custom_roll(s, ref - peak)
+
+        n_spikes = self.shapes.shape[0]
+        starts = np.arange(0, n_spikes, chunk_size)
+        # partial_fit needs at least n_components samples, so a short last
+        # batch is merged into the previous one
+        if len(starts) > 1 and n_spikes - starts[-1] < pca_ncomponents:
+            starts = starts[:-1]
+        batches = list(zip(starts, np.append(starts[1:], n_spikes)))
+
         if custom_decomposition is None:  # default is PCA
-            _pca = PCA(n_components=pca_ncomponents, whiten=pca_whiten)
+            _pca = IncrementalPCA(
+                n_components=pca_ncomponents, whiten=pca_whiten, batch_size=chunk_size
+            )
+            if self.verbose:
+                print(f"Fitting PCA using all {n_spikes} spikes...")
+            # all batches are aligned to the same reference sample, taken from
+            # the first one, so that the incremental fit sees consistent data
+            ref = None
+            for start, stop in batches:
+                s = self.shapes[start:stop].astype(np.float32)
+                if ref is None:
+                    ref = np.min(peaks(s))
+                _pca.partial_fit(align_peaks(s, ref))
         else:  # Accepts an arbitrary sklearn.decomposition object instead of PCA
             _pca = custom_decomposition
-
-        if n_spikes > chunk_size:
-            if self.verbose:
-                print(
-                    f"Fitting dimensionality reduction using {chunk_size} out of {n_spikes} spikes..."
-                )
-            inds = np.sort(np.random.choice(n_spikes, chunk_size, replace=False))
-            s = self.spikes.Shape.loc[inds].values.tolist()
-        else:
-            if self.verbose:
-                print("Fitting dimensionality reduction using all spikes...")
-            s = self.spikes.Shape.values.tolist()
-        # align peaks
-        peak = np.argmin(np.diff(np.asarray(s).T, axis=0), axis=0)
-        shift = np.min(peak) - peak
-        s_roll = custom_roll(np.asarray(s), shift)
-
-        _pca.fit(np.asarray(s_roll))
+            if n_spikes > chunk_size:
+                if self.verbose:
+                    print(
+                        f"Fitting dimensionality reduction using {chunk_size} out of {n_spikes} spikes..."
+                    )
+                inds = np.sort(_sample_indices(n_spikes, chunk_size))
+                s = self.shapes[inds]
+            else:
+                if self.verbose:
+                    print("Fitting dimensionality reduction using all spikes...")
+                s = self.shapes
+            _pca.fit(align_peaks(s.astype(np.float32)))
 
         if self.verbose:
             print("...projecting...")
-        _pcs = np.empty((n_spikes, pca_ncomponents))
-        for i in range(n_spikes // chunk_size + 1):
-            # is this the best way? Warning: Pandas slicing with .loc is different!
-            s = self.spikes.Shape.loc[
-                i * chunk_size : (i + 1) * chunk_size - 1
-            ].values.tolist()
-            # align peaks
-            peak = np.argmin(np.diff(np.asarray(s).T, axis=0), axis=0)
-            shift = np.min(peak) - peak
-            s_roll = custom_roll(np.asarray(s), shift)
-            _pcs[i * chunk_size : (i + 1) * chunk_size, :] = _pca.transform(s)
+        _pcs = np.concatenate(
+            [
+                _pca.transform(self.shapes[start:stop].astype(np.float32))
+                for start, stop in batches
+            ]
+        )
 
         self.pca = _pca
         self.features = _pcs
@@ -1017,8 +1383,10 @@ class HSClustering(object):
     ):
         if limits is not None:
             spikes = self.spikes[limits[0] : limits[1]]
+            shapes = self.shapes[limits[0] : limits[1]]
         else:
             spikes = self.spikes
+            shapes = self.shapes
 
         g = h5py.File(filename, "w")
         if transpose:
@@ -1045,15 +1413,17 @@ class HSClustering(object):
             g.create_dataset("cluster_id", data=[])
 
         g.create_dataset("exp_inds", data=self.expinds)
-        # this is still a little slow (and perhaps memory intensive)
-        # but I have not yet found a better way:
         if save_shapes and not spikes.empty:
-            cutout_length = spikes.Shape.iloc[0].size
-            g.create_dataset("cutout_length", data=cutout_length)
-            sh_tmp = np.empty((cutout_length, spikes.Shape.size))
-            for i, s in enumerate(spikes.Shape):
-                sh_tmp[:, i] = s
-            g.create_dataset("shapes", data=sh_tmp, compression=compression)
+            g.create_dataset("cutout_length", data=shapes.shape[1])
+            # chunks hold whole cut-outs for a block of spikes, matching how
+            # LoadHDF5 reads them back
+            g.create_dataset(
+                "shapes",
+                data=shapes.T,
+                chunks=(shapes.shape[1], min(4096, shapes.shape[0])),
+                shuffle=compression is not None,
+                compression=compression,
+            )
         else:
             g.create_dataset("shapes", data=[], compression=compression)
         g.close()
@@ -1061,15 +1431,15 @@ class HSClustering(object):
     def SaveHDF5(
         self,
         filename,
-        compression=None,
+        compression="lzf",
         sampling=None,
         transpose=False,
         save_shapes=True,
     ):
         """
-        Saves data, cluster centres and ClusterIDs to a hdf5 file. Offers
-        compression of the shapes, 'lzf' appears a good trade-off between speed
-        and performance.
+        Saves data, cluster centres and ClusterIDs to a hdf5 file. Shapes are
+        compressed with 'lzf' by default, which appears a good trade-off between
+        speed and performance, combined with the shuffle filter.
 
         If filename is a single name, then all will be saved to a single file.
         If filename is a list of names of the same length as the number of
@@ -1080,7 +1450,8 @@ class HSClustering(object):
         filename : str or list
             The names of the file or list of files to be saved.
         compression : str
-            Passed to HDF5, to save shapes compressed.
+            Passed to HDF5, to save shapes compressed. Default is 'lzf', None
+            disables compression.
         sampling : float
             Provide sampling rate to include it in the file.
         transpose : bool
@@ -1152,61 +1523,52 @@ class HSClustering(object):
         print("Reading from clustered (HS1 or HS2) file " + filename)
 
         print(
-            f"Creating memmapped cache for shapes, reading in chunks of size {chunk_size} and converting to integer..."
-        )
-        i = len(self.shapecache)
-        self.shapecache.append(
-            np.memmap(
-                "tmp" + str(i) + ".bin",
-                dtype=np.int32,
-                mode="w+",
-                shape=g["shapes"].shape[::-1],
-            )
+            f"Reading shapes in chunks of size {chunk_size} and converting to integer..."
         )
-        for i in range(g["shapes"].shape[1] // chunk_size + 1):
-            tmp = (
-                scale
-                * np.transpose(g["shapes"][:, i * chunk_size : (i + 1) * chunk_size])
-            ).astype(np.int32)
-            print("Read chunk " + str(i + 1))
-            self.shapecache[-1][i * chunk_size : (i + 1) * chunk_size] = tmp[:]
+        shapes = _read_shapes(g["shapes"], chunk_size, scale)
 
-        self.cutout_length = self.shapecache[-1].shape[1]
-        print("Events: ", self.shapecache[-1].shape[0])
+        self.cutout_length = shapes.shape[1]
+        print("Events: ", shapes.shape[0])
         print("Cut-out size: ", self.cutout_length)
 
+        # all columns are built with their final dtype first, so the frame is
+        # constructed once without inserting columns afterwards
+        if "ch" in list(g.keys()):
+            ch = _read_direct(g["ch"]).T
+        else:
+            ch = np.zeros(g["times"].shape[0], dtype=int)
+        # HS1 files store locations as one (2, n_spikes) array, SaveHDF5 as x and y
+        if "data" in list(g.keys()):
+            x, y = _read_direct(g["data"], np.float32)
+        else:
+            x = _read_direct(g["x"], np.float32)
+            y = _read_direct(g["y"], np.float32)
+
+        print("Getting spike amplitudes")
+        amplitude = shapes.min(axis=1)
+
         spikes = pd.DataFrame(
             {
-                "ch": np.zeros(g["times"].shape[0], dtype=int),
-                "t": g["times"],
-                "Amplitude": np.zeros(g["times"].shape[0], dtype=int),
-                "x": g["data"][0, :],
-                "y": g["data"][1, :],
-                "Shape": list(self.shapecache[-1]),
+                "ch": ch,
+                "t": _read_direct(g["times"]),
+                "Amplitude": amplitude,
+                "x": x,
+                "y": y,
+                "min_amp": amplitude,
             },
             copy=False,
         )
 
-        if "ch" in list(g.keys()):
-            spikes.ch = g["ch"].value.T
-
-        print("Getting spike amplitudes")
-        spikes["min_amp"] = spikes.Shape.apply(min_func)
-        spikes["Amplitude"] = spikes["min_amp"]
-
         if "centres" in list(g.keys()):
-            self.centerz = g["centres"].value
+            self.centerz = _read_direct(g["centres"], np.float32)
             if len(self.centerz) < 5:
                 print("WARNING Hack: Assuming HS1 data format")
                 self.centerz = self.centerz.T
             self.NClusters = len(self.centerz)
             print("Number of clusters: ", self.NClusters)
-            spikes["cl"] = g["cluster_id"]
+            spikes["cl"] = _read_direct(g["cluster_id"])
 
-            inds = spikes.groupby(["cl"]).cl.count().index
-            _cl = spikes.groupby(["cl"])
-            _cls = np.zeros(self.NClusters)
-            _cls[inds] = _cl.cl.count()
+            _cls = np.bincount(spikes.cl.to_numpy(), minlength=self.NClusters)
 
             dic_cls = {
                 "ctr_x": self.centerz[:, 0],
@@ -1221,14 +1583,7 @@ class HSClustering(object):
 
         g.close()
 
-        if append:
-            self.expinds.append(len(self.spikes))
-            self.spikes = pd.concat([self.spikes, spikes], ignore_index=True)
-            self.filelist.append(filename)
-        else:
-            self.spikes = spikes
-            self.expinds = [0]
-            self.filelist = [filename]
+        self._add_experiment(spikes, shapes, filename, append)
 
     def LoadHDF5_legacy_detected(
         self, filename, append=False, chunk_size=1000000, scale=1.0
@@ -1253,34 +1608,26 @@ class HSClustering(object):
         if scale == 1:
             scale = -1.0 * g["Ascale"].value
         print(
-            "Creating memmapped cache for shapes, reading in chunks of size",
+            "Reading shapes in chunks of size",
             chunk_size,
             "and converting to integer...",
         )
-        i = len(self.shapecache)
-        self.shapecache.append(
-            np.memmap(
-                "tmp" + str(i) + ".bin",
-                dtype=np.int32,
-                mode="w+",
-                shape=g["Shapes"].shape,
-            )
-        )
-        for i in range(g["Shapes"].shape[0] // chunk_size + 1):
-            tmp = (
-                (scale * g["Shapes"][i * chunk_size : (i + 1) * chunk_size, :].T)
-                .astype(np.int32)
-                .T
+        shapes = _empty_shapes(g["Shapes"].shape)
+        for i, start in enumerate(range(0, shapes.shape[0], chunk_size)):
+            out = shapes[start : start + chunk_size]
+            np.multiply(
+                g["Shapes"][start : start + chunk_size], scale, out=out, casting="unsafe"
             )
-            inds = np.where(tmp > 20000)[0]
-            tmp[inds] = 0
+            # spikes with any sample out of the linear regime are zeroed
+            mask = out > 20000
+            n_out = np.count_nonzero(mask)
             print("Read chunk " + str(i + 1))
-            if len(inds) > 0:
-                print("Found", len(inds), "data points out of linear regime")
-            self.shapecache[-1][i * chunk_size : (i + 1) * chunk_size] = tmp[:]
+            if n_out > 0:
+                out[mask.any(axis=1)] = 0
+                print("Found", n_out, "data points out of linear regime")
 
-        self.cutout_length = self.shapecache[-1].shape[1]
-        print("Events: ", self.shapecache[-1].shape[0])
+        self.cutout_length = shapes.shape[1]
+        print("Events: ", shapes.shape[0])
         print("Cut-out size: ", self.cutout_length)
 
         spikes = pd.DataFrame(
@@ -1290,7 +1637,6 @@ class HSClustering(object):
                 "Amplitude": (-g["Amplitudes"][:] * scale).astype(int),
                 "x": g["Locations"][:, 0],
                 "y": g["Locations"][:, 1],
-                "Shape": list(self.shapecache[-1]),
             },
             copy=False,
         )
@@ -1299,14 +1645,7 @@ class HSClustering(object):
 
         g.close()
 
-        if append:
-            self.expinds.append(len(self.spikes))
-            self.spikes = pd.concat([self.spikes, spikes], ignore_index=True)
-            self.filelist.append(filename)
-        else:
-            self.spikes = spikes
-            self.expinds = [0]
-            self.filelist = [filename]
+        self._add_experiment(spikes, shapes, filename, append)
 
     def LoadBin(self, filename, cutout_length, append=False):
         """
@@ -1324,40 +1663,30 @@ class HSClustering(object):
         """
         # 5 here are the non-shape data columns
         print("# loading", filename)
-        self.shapecache.append(
-            np.memmap(filename, dtype=np.int32, mode="r").reshape(
-                (-1, cutout_length + 5)
-            )
-        )
-        assert self.shapecache[-1].shape[0] // (
-            cutout_length + 5
-        ) is not self.shapecache[-1].shape[0] / (
-            cutout_length + 5
-        ), "spike data has wrong dimensions"  # ???
+        data = np.memmap(filename, dtype=np.int32, mode="r")
+        assert (
+            data.shape[0] % (cutout_length + 5) == 0
+        ), "spike data has wrong dimensions"
+        data = data.reshape((-1, cutout_length + 5))
+        # integer columns and shapes are views into the memmap, only the
+        # locations are converted (to single precision)
         spikes = pd.DataFrame(
             {
-                "ch": self.shapecache[-1][:, 0],
-                "t": self.shapecache[-1][:, 1],
-                "Amplitude": self.shapecache[-1][:, 2],
-                "x": self.shapecache[-1][:, 3] / 1000,
-                "y": self.shapecache[-1][:, 4] / 1000,
-                "Shape": list(self.shapecache[-1][:, 5:]),
+                "ch": data[:, 0],
+                "t": data[:, 1],
+                "Amplitude": data[:, 2],
+                "x": np.divide(data[:, 3], 1000, dtype=np.float32),
+                "y": np.divide(data[:, 4], 1000, dtype=np.float32),
             },
             copy=False,
         )
+        shapes = data[:, 5:]
         self.IsClustered = False
 
         # this computes average amplitudes, disabled for now
-        # spikes['min_amp'] = spikes.Shape.apply(min_func)
+        # spikes['min_amp'] = shapes.min(axis=1)
 
-        if append:
-            self.expinds.append(len(self.spikes))
-            self.spikes = pd.concat([self.spikes, spikes], ignore_index=True)
-            self.filelist.append(filename)
-        else:
-            self.spikes = spikes
-            self.expinds = [0]
-            self.filelist = [filename]
+        self._add_experiment(spikes, shapes, filename, append)
 
     def PlotShapes(
         self,
@@ -1381,35 +1710,39 @@ class HSClustering(object):
             them out.
         """
         nrows = int(np.ceil(len(units) / ncols))
-        cutouts = self.spikes.Shape
+        cutouts = self.shapes
 
         # all this is to determine suitable ylims TODO probe should provide
         yoff = 0
         if ylim is None:
-            meanshape = np.mean(np.vstack(cutouts.loc[:1000].values), axis=0)
+            sample = cutouts[:1001].astype(np.float32)
+            meanshape = np.mean(sample, axis=0)
             yoff = -meanshape[0]
             maxy, miny = meanshape.max() + yoff, meanshape.min() + yoff
-            varshape = np.var(cutouts.loc[:1000].values, axis=0)
+            # reuse the mean rather than letting np.var compute it again
+            varshape = np.mean((sample - meanshape) ** 2, axis=0)
             varmin = varshape[np.argmin(meanshape)]
             varmax = varshape[np.argmax(meanshape)]
             maxy += 4.0 * np.sqrt(varmax)
             miny -= 2.0 * np.sqrt(varmin)
             ylim = [miny, maxy]
 
+        rgba = self._cluster_colors()
+        self._check_cluster_caches()
         plt.figure(figsize=(3 * ncols, 3 * nrows))
         for i, cl in enumerate(units):
-            inds = np.where(self.spikes.cl == cl)[0][:max_shapes]
-            meanshape = np.mean(np.vstack(cutouts.loc[inds].values), axis=0)
+            inds = self._cluster_spikes(cl)[:max_shapes]
+            meanshape = np.mean(cutouts[inds], axis=0, dtype=np.float32)
             yoff = -meanshape[0]
 
             plt.subplot(nrows, ncols, i + 1)
             plt.plot(
-                np.vstack(cutouts.loc[inds[:50]].values).T,
+                cutouts[inds[:50]].T,
                 color=(0.8, 0.8, 0.8),
                 lw=0.8,
             )
 
-            plt.plot(meanshape + yoff, c=plt.cm.hsv(self.clusters.Color[cl]), lw=4)
+            plt.plot(meanshape + yoff, c=rgba[cl], lw=4)
             plt.ylim(ylim)
             plt.title("Cluster " + str(cl))
         plt.tight_layout()
@@ -1455,13 +1788,14 @@ class HSClustering(object):
         if invert:
             x, y = y, x
         if self.spikes.shape[0] > max_show:
-            inds = np.random.choice(n_spikes, max_show, replace=False)
+            inds = _sample_indices(n_spikes, max_show)
             print("We have", n_spikes, "spikes, only showing ", max_show)
         else:
             inds = np.arange(n_spikes)
 
-        c = plt.cm.hsv(self.clusters.Color[self.spikes.cl])
-        ax.scatter(x[inds], y[inds], c=c[inds], **kwargs)
+        # cluster colours are cached, gather them for the shown spikes
+        c = self._cluster_colors()[self.spikes.cl.to_numpy()[inds]]
+        ax.scatter(x.to_numpy()[inds], y.to_numpy()[inds], c=c, **kwargs)
         if show_labels and self.IsClustered:
             ctr_x, ctr_y = self.clusters.ctr_x, self.clusters.ctr_y
             if invert:
@@ -1480,7 +1814,11 @@ class HSClustering(object):
         alpha=0.4,
         show_unclustered=False,
         max_shapes=1000,
+        max_clusters=12,
+        shape_score=None,
         figsize=(8, 6),
+        backend="matplotlib",
+        backend_threshold=10000,
     ):
         """
         Plot all units and spikes in the neighbourhood of cluster cl.
@@ -1499,8 +1837,22 @@ class HSClustering(object):
             Whether to show unclustered spikes (left by certain clustering algorithms)
         max_shapes : int
             Maximum number of shapes to be plotted
+        max_clusters : int
+            Maximum number of units shown, the ones closest to cluster cl are
+            kept
+        shape_score : array, optional
+            A score for every spike. The individual shapes drawn for each unit
+            are the ones with the lowest score, rather than the first ones
         figsize : tuple
             The size of the figure
+        backend : str
+            How to draw the spike positions: "matplotlib", "datashader",
+            "jscatter" (these two need the respective package installed) or
+            "auto", which uses datashader for at least backend_threshold
+            spikes and matplotlib otherwise
+        backend_threshold : int
+            The number of shown spikes from which backend="auto" switches to
+            datashader
 
         Returns
         -------
@@ -1508,65 +1860,89 @@ class HSClustering(object):
             The axis with the plot.
         """
 
-        plt.figure(figsize=figsize)
-
-        cx, cy = self.clusters["ctr_x"][cl], self.clusters["ctr_y"][cl]
-        dists = np.sqrt(
-            (cx - self.clusters["ctr_x"]) ** 2 + (cy - self.clusters["ctr_y"]) ** 2
-        )
-        clInds = np.where(dists < radius)[0]
-
-        ax = []
-        ax.append(
-            plt.subplot2grid(
-                (len(clInds) + 1, 4),
-                (0, 0),
-                rowspan=len(clInds) + 1,
-                colspan=3,
-                facecolor="k",
+        if backend not in ("matplotlib", "datashader", "jscatter", "auto"):
+            raise ValueError(
+                "Unknown backend {}, expected matplotlib, datashader, jscatter "
+                "or auto".format(backend)
             )
+        fig = plt.figure(figsize=figsize)
+        if shape_score is not None:
+            shape_score = np.asarray(shape_score)
+
+        ctr_x = self.clusters["ctr_x"].to_numpy()
+        ctr_y = self.clusters["ctr_y"].to_numpy()
+        sx, sy = self.spikes.x.to_numpy(), self.spikes.y.to_numpy()
+        rgba = self._cluster_colors()
+        self._check_cluster_caches()
+        clInds, groups, means, spInds = self._neighbourhood(
+            cl, radius, max_shapes, max_clusters, show_unclustered
         )
+
+        # spikes on the left, one row of shapes per unit on the right, all
+        # shape panels share the y axis of the first one
+        gs = fig.add_gridspec(len(clInds) + 1, 4)
+        ax = [fig.add_subplot(gs[:, :3], facecolor="k")]
         for i in range(len(clInds) + 1):
-            ax.append(plt.subplot2grid((len(clInds) + 1, 4), (i, 3), colspan=1))
+            ax.append(fig.add_subplot(gs[i, 3], sharey=ax[1] if i > 0 else None))
             ax[i + 1].axis("off")
-            if i > 0:
-                ax[i].sharey(ax[i + 1])
-
-        for i_cl, cl_t in enumerate(clInds):
-            cx, cy = self.clusters["ctr_x"][cl_t], self.clusters["ctr_y"][cl_t]
-            inds = np.where(self.spikes.cl == cl_t)[0][:max_shapes]
-            x, y = self.spikes.x[inds], self.spikes.y[inds]
-            ax[0].scatter(
-                x, y, color=plt.cm.hsv(self.clusters["Color"][cl_t]), s=3, alpha=alpha
+
+        # spikes of all clusters in a single scatter, coloured per cluster
+        if len(groups):
+            allinds = np.concatenate(groups)
+            if backend == "auto":
+                if len(allinds) >= backend_threshold:
+                    backend = "datashader"
+                else:
+                    backend = "matplotlib"
+            labels = np.repeat(
+                np.arange(len(groups)), [len(inds) for inds in groups]
+            )
+            _render_scatter(
+                ax[0],
+                sx[allinds],
+                sy[allinds],
+                labels,
+                rgba[clInds],
+                alpha,
+                backend,
             )
+        for i_cl, (cl_t, inds) in enumerate(zip(clInds, groups)):
+            cx, cy = ctr_x[cl_t], ctr_y[cl_t]
             if show_cluster_numbers:
                 ax[0].text(cx - 0.1, cy, str(cl_t), fontsize=16, color="w")
-            ax[i_cl + 2].plot(
-                np.vstack(self.spikes.loc[inds[:50]].Shape.values).T,
-                color=(0.8, 0.8, 0.8),
-                lw=0.8,
+            shown = _select_first(inds, 50, shape_score)
+            ax[i_cl + 2].add_collection(
+                LineCollection(
+                    _shape_segments(self.shapes[shown]),
+                    colors=[(0.8, 0.8, 0.8)],
+                    linewidths=0.8,
+                )
             )
+            ax[i_cl + 2].autoscale_view()
             if len(inds) > 1:
                 ax[i_cl + 2].plot(
-                    np.mean(np.vstack(self.spikes.loc[inds].Shape.values), axis=0),
-                    color=plt.cm.hsv(self.clusters["Color"][cl_t]),
+                    means[i_cl],
+                    color=rgba[cl_t],
                     lw=2,
                 )
 
         ax[0].axis("equal")
 
         # show unclustered spikes (if any)
-        if show_unclustered:
-            cx, cy = self.clusters["ctr_x"][cl], self.clusters["ctr_y"][cl]
-            inds = np.where(self.spikes.cl == self.NClusters - 1)[0][:max_shapes]
-            x, y = self.spikes.x[inds].values, self.spikes.y[inds].values
-            dists = np.sqrt((cx - x) ** 2 + (cy - y) ** 2)
-            spInds = np.where(dists < radius)[0]
-            if len(spInds):
-                ax[0].scatter(x[spInds], y[spInds], c="w", s=3)
-                for i in spInds[:20]:
-                    ax[1].plot(self.spikes.Shape[i], color=(0.4, 0.4, 0.4))
-                ax[1].plot(np.mean(self.spikes.Shape[spInds].values, axis=0), color="k")
+        if show_unclustered and len(spInds):
+            ax[0].scatter(sx[spInds], sy[spInds], c="w", s=3)
+            ax[1].add_collection(
+                LineCollection(
+                    _shape_segments(
+                        self.shapes[_select_first(spInds, 20, shape_score)]
+                    ),
+                    colors=[(0.4, 0.4, 0.4)],
+                )
+            )
+            ax[1].autoscale_view()
+            ax[1].plot(np.mean(self.shapes[spInds], axis=0), color="k")
+        # leave drawing to the event loop instead of blocking on it here
+        fig.canvas.draw_idle()
         return ax
 
 